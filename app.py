@@ -1,3 +1,10 @@
+import csv
+import hashlib
+import io
+import warnings
+
+import numpy as np
+import pandas as pd
 import streamlit as st
 from datetime import datetime
 import pytz
@@ -19,9 +26,52 @@ LAYOUT_OPTIONS = {
     "Layout 4": "L4",
 }
 
+# Abreviações de layout para o nome do arquivo de download, com o replace
+# resolvido uma única vez no import em vez de a cada chamada.
+_LAYOUT_SHORT = {layout: short.replace(" ", "") for layout, short in LAYOUT_OPTIONS.items()}
+
+# Sufixos de saída pré-computados por layout: Apha7 e InovaFarma não levam
+# sufixo, os demais recebem o nome do layout sem espaços. Resolver isso uma
+# vez no import evita refazer replace/branch a cada formatação.
+_LAYOUT_SUFFIX = {
+    layout: "" if layout in ("Layout Apha7", "Layout InovaFarma") else layout.replace(" ", "")
+    for layout in LAYOUT_OPTIONS
+}
+
+# Modelos das mensagens de erro. As linhas com problema ficam guardadas como
+# tuplas (arquivo, linha, tipo, valor) e só viram texto na hora de exibir,
+# sem repetir o nome do arquivo em cada mensagem armazenada.
+_ERROR_TEMPLATES = {
+    'read_error': "Erro ao ler o arquivo '{name}': {value}",
+    'bad_format': "Arquivo '{name}', Linha {line}: Formato inválido. Esperado 'CODIGO,QUANTIDADE'.",
+    'empty_code': "Arquivo '{name}', Linha {line}: O código de barras não pode estar vazio.",
+    'bad_quantity': "Arquivo '{name}', Linha {line}: Quantidade '{value}' não é um número inteiro válido.",
+    'negative': "Arquivo '{name}', Linha {line}: A quantidade não pode ser um número negativo.",
+}
+
+# pytz.timezone refaz o parse do tzdb a cada chamada; o cache garante que
+# cada fuso horário seja construído uma única vez por sessão.
+_TZ_CACHE: Dict[str, Any] = {}
+
+def _get_tz(timezone_str: str) -> Any:
+    """Retorna o fuso horário do pytz, construindo-o apenas na primeira vez."""
+    tz = _TZ_CACHE.get(timezone_str)
+    if tz is None:
+        tz = _TZ_CACHE.setdefault(timezone_str, pytz.timezone(timezone_str))
+    return tz
+
+def _empty_state_df() -> pd.DataFrame:
+    """DataFrame vazio com o esquema do estado agregado da sessão."""
+    return pd.DataFrame({
+        'code': pd.Series(dtype=object),
+        'quantity': pd.Series(dtype='int64'),
+    })
+
 # --- Inicialização do Estado da Sessão ---
 if 'processed_data' not in st.session_state:
-    st.session_state.processed_data = []
+    st.session_state.processed_data = _empty_state_df()
+if 'total_rows' not in st.session_state:
+    st.session_state.total_rows = 0
 if 'errors' not in st.session_state:
     st.session_state.errors = []
 if 'processed_files' not in st.session_state:
@@ -29,112 +79,246 @@ if 'processed_files' not in st.session_state:
 
 # --- Funções de Lógica de Negócio ---
 
-def parse_uploaded_file(uploaded_file: Any) -> Tuple[List[Dict[str, Any]], List[str]]:
-    """Lê um arquivo .txt enviado, valida cada linha e extrai os dados."""
-    processed_data = []
-    errors = []
-    
+def parse_uploaded_file(uploaded_file: Any, max_rows: int = 0) -> Tuple[np.ndarray, np.ndarray, List[Tuple[int, str, Any]]]:
+    """Lê um arquivo .txt enviado, valida cada linha e extrai os dados.
+
+    Retorna arrays paralelos de códigos e quantidades (layout colunar), em
+    vez de um dicionário por linha — uma fração da memória e buffers prontos
+    para as operações vetorizadas seguintes. Os erros saem como tuplas
+    (linha, tipo, valor) e só são formatados em texto na exibição.
+
+    Com `max_rows` > 0 a leitura para nesse limite: o restante de um arquivo
+    grande demais nem chega a ser decodificado.
+
+    O trabalho pesado fica em `_parse_file_content`, memoizada por conteúdo:
+    reruns do Streamlit com o mesmo arquivo reaproveitam o resultado em cache.
+    """
     if not uploaded_file:
-        return [], []
+        return _EMPTY_CODES, _EMPTY_QUANTITIES, []
+
+    uploaded_file.seek(0)
+
+    return _parse_file_content(uploaded_file.getvalue(), max_rows)
+
+_EMPTY_CODES = np.empty(0, dtype=object)
+_EMPTY_QUANTITIES = np.empty(0, dtype='int64')
 
+@st.cache_data(show_spinner=False)
+def _parse_file_content(raw: bytes, max_rows: int = 0) -> Tuple[np.ndarray, np.ndarray, List[Tuple[int, str, Any]]]:
+    """Faz o parse e a validação do conteúdo bruto de um arquivo enviado."""
+    errors = []
+
+    # O buffer binário vai direto para o read_csv: o engine C decodifica
+    # UTF-8 e tokeniza na mesma passada, sem uma etapa .decode() separada
+    # varrendo o arquivo inteiro antes do parse, e sem o custo de um laço
+    # Python por linha. A coluna "extra" captura linhas com campos a mais
+    # para a validação de formato abaixo.
+    read_kwargs = dict(
+        encoding="utf-8",
+        header=None,
+        names=["code", "quantity", "extra"],
+        index_col=False,
+        dtype=str,
+        skip_blank_lines=False,
+        skipinitialspace=True,
+        keep_default_na=False,
+        na_values=[],
+        # O split(',') original tratava aspas como dado literal: '"ABC",5'
+        # tem código '"ABC"' e '"AB,C",5' são três campos (formato inválido).
+        quoting=csv.QUOTE_NONE,
+        nrows=max_rows if max_rows > 0 else None,
+    )
     try:
-        uploaded_file.seek(0)
-        lines = uploaded_file.read().decode("utf-8").splitlines()
-    except Exception as e:
-        errors.append(f"Erro ao ler o arquivo '{uploaded_file.name}': {e}")
-        return [], errors
-
-    for line_num, line in enumerate(lines, 1):
-        stripped_line = line.strip()
-        if not stripped_line:
-            continue
-
-        parts = stripped_line.split(',')
-        if len(parts) != 2:
-            errors.append(f"Arquivo '{uploaded_file.name}', Linha {line_num}: Formato inválido. Esperado 'CODIGO,QUANTIDADE'.")
-            continue
-
-        code = parts[0].strip()
-        quantity_str = parts[1].strip()
-
-        if not code:
-            errors.append(f"Arquivo '{uploaded_file.name}', Linha {line_num}: O código de barras não pode estar vazio.")
-            continue
-        
         try:
-            quantity = int(quantity_str)
-            if quantity < 0:
-                 errors.append(f"Arquivo '{uploaded_file.name}', Linha {line_num}: A quantidade não pode ser um número negativo.")
-                 continue
-            processed_data.append({"code": code, "quantity": quantity})
-        except ValueError:
-            errors.append(f"Arquivo '{uploaded_file.name}', Linha {line_num}: Quantidade '{quantity_str}' não é um número inteiro válido.")
-            
-    return processed_data, errors
-
-def aggregate_data(data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            df = pd.read_csv(io.BytesIO(raw), engine="c", **read_kwargs)
+        except pd.errors.ParserError:
+            # Linha com 4+ campos aborta o engine C. O engine python aceita um
+            # on_bad_lines que trunca a linha para a largura esperada, mantendo
+            # a posição dela (a coluna "extra" sobrevive e vira 'Formato
+            # inválido' por linha) e todas as demais linhas do arquivo. O aviso
+            # de largura é justamente o caso tratado, então fica silenciado.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", pd.errors.ParserWarning)
+                df = pd.read_csv(
+                    io.BytesIO(raw),
+                    engine="python",
+                    on_bad_lines=lambda fields: fields[:3],
+                    **read_kwargs,
+                )
+            # Ao contrário do engine C, o engine python preenche campos
+            # ausentes com NaN mesmo com keep_default_na=False; normaliza
+            # para "" para as máscaras enxergarem o mesmo formato.
+            df = df.fillna("")
+    except pd.errors.EmptyDataError:
+        return _EMPTY_CODES, _EMPTY_QUANTITIES, []
+    except Exception as e:
+        errors.append((0, 'read_error', str(e)))
+        return _EMPTY_CODES, _EMPTY_QUANTITIES, errors
+
+    # Só a coluna de código precisa de strip próprio: o tokenizador já comeu
+    # os espaços depois da vírgula (skipinitialspace) e a validação numérica
+    # abaixo tolera espaços ao redor, então a coluna de quantidade dispensa
+    # uma passada extra de .str.strip().
+    #
+    # A validação usa a forma textual, com a mesma regra do int() original:
+    # só dígitos (e sinal) passam — "10.0" e "1e2" continuam inválidos. O
+    # fullmatch roda vetorizado sobre a coluna inteira, nada de int() por
+    # linha, e o pd.to_numeric converte apenas as linhas aprovadas.
+    #
+    # O limite de 18 dígitos significativos garante que todo valor aprovado
+    # caiba em int64 (o tipo do estado da sessão): quantidades maiores são
+    # rejeitadas como inválidas em vez de estourarem silenciosamente no
+    # caminho float64 do to_numeric. O reindex preenche com 0 (e não NaN)
+    # justamente para a série continuar inteira e exata.
+    code = df["code"].str.strip()
+    quantity_str = df["quantity"]
+    quantity_ok = quantity_str.str.fullmatch(r"\s*[+-]?0*\d{1,18}\s*", na=False)
+    quantity = (
+        pd.to_numeric(quantity_str[quantity_ok], errors="coerce")
+        .reindex(df.index, fill_value=0)
+    )
+
+    # Máscaras booleanas de validação, avaliadas em bloco sobre as colunas.
+    # Cada máscara exclui as anteriores para manter um único erro por linha,
+    # na mesma precedência do parse original. Com keep_default_na=False nada
+    # vira NaN — campo ausente chega como "" e códigos literais como "NA" ou
+    # "NaN" permanecem códigos, em vez de serem filtrados como nulos.
+    blank = (code == "") & (quantity_str == "") & (df["extra"] == "")
+    bad_format = ~blank & ((df["extra"] != "") | (quantity_str == ""))
+    empty_code = ~blank & ~bad_format & (code == "")
+    bad_quantity = ~blank & ~bad_format & ~empty_code & ~quantity_ok
+    negative = ~blank & ~bad_format & ~empty_code & ~bad_quantity & (quantity < 0)
+    valid = ~blank & ~bad_format & ~empty_code & ~bad_quantity & ~negative
+
+    errors.extend((i + 1, 'bad_format', None) for i in df.index[bad_format])
+    errors.extend((i + 1, 'empty_code', None) for i in df.index[empty_code])
+    errors.extend((i + 1, 'bad_quantity', quantity_str[i].strip()) for i in df.index[bad_quantity])
+    errors.extend((i + 1, 'negative', None) for i in df.index[negative])
+    errors.sort()
+
+    codes = code[valid].to_numpy()
+    quantities = quantity[valid].to_numpy(dtype="int64")
+
+    return codes, quantities, errors
+
+def file_identity_key(uploaded_file: Any) -> str:
+    """Gera a chave de identidade de um upload para a deduplicação.
+
+    O nome sozinho confunde arquivos diferentes com o mesmo nome (e vice-
+    versa); a chave combina nome, tamanho e um BLAKE2b dos primeiros 4 KB,
+    ficando O(1) mesmo para arquivos grandes.
+    """
+    uploaded_file.seek(0)
+    head = uploaded_file.read(4096)
+    uploaded_file.seek(0)
+
+    size = getattr(uploaded_file, "size", len(head))
+    digest = hashlib.blake2b(head, digest_size=16)
+    digest.update(f"|{uploaded_file.name}|{size}".encode("utf-8"))
+
+    return digest.hexdigest()
+
+def format_error_messages(errors: List[Tuple[str, int, str, Any]]) -> str:
+    """Renderiza as tuplas de erro acumuladas em uma única string de exibição.
+
+    A formatação acontece só aqui, uma vez por exibição, com um único join —
+    nada de construir N strings durante o parse.
     """
-    Agrega dados somando as quantidades para códigos de barras idênticos.
+    return "\n".join(
+        "- " + _ERROR_TEMPLATES[kind].format(name=name, line=line, value=value)
+        for name, line, kind, value in errors
+    )
 
-    Args:
-        data: Uma lista de dicionários, potencialmente com códigos duplicados.
+def _sum_by_code(codes: np.ndarray, quantities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Soma as quantidades por código em uma única passada O(N) no NumPy.
 
-    Returns:
-        Uma nova lista de dicionários com códigos únicos e quantidades somadas.
+    `np.unique` + `np.add.at` dispensam o hash map da agregação: o inverse
+    index vira posição num array plano de somas, acumulando direto em int64
+    — `np.bincount` somaria em float64 e perderia exatidão acima de 2^53.
+    Os códigos permanecem como strings — converter para inteiro descartaria
+    zeros à esquerda (078901).
     """
-    summed_quantities = {}
-    for item in data:
-        code = item['code']
-        quantity = item['quantity']
-        # Adiciona a quantidade ao código existente ou o inicializa
-        summed_quantities[code] = summed_quantities.get(code, 0) + quantity
-
-    # Converte o dicionário agregado de volta para o formato de lista de dicionários
-    aggregated_list = [{'code': code, 'quantity': quantity} for code, quantity in summed_quantities.items()]
-    
-    return aggregated_list
+    unique_codes, inverse = np.unique(codes, return_inverse=True)
+    sums = np.zeros(len(unique_codes), dtype=np.int64)
+    np.add.at(sums, inverse, quantities)
 
-def format_output_data(data: List[Dict[str, Any]], layout: str, timezone_str: str) -> str:
-    """Formata os dados processados no layout de saída especificado."""
-    sorted_data = sorted(data, key=lambda x: x['quantity'])
+    return unique_codes, sums
 
+def accumulate_data(state: pd.DataFrame, codes: np.ndarray, quantities: np.ndarray) -> pd.DataFrame:
+    """
+    Incorpora os arrays de um arquivo ao DataFrame agregado da sessão.
+
+    Duplicatas dentro do próprio arquivo são somadas primeiro (unique +
+    bincount, direto sobre os arrays colunares); um concat + groupby então
+    funde o resultado com o estado já agregado, tudo em buffers contíguos.
+    A memória fica limitada ao número de códigos únicos, não ao total de
+    linhas enviadas, e o clique de Processar recebe o estado já consolidado.
+    """
+    if len(codes) == 0:
+        return state
+
+    unique_codes, sums = _sum_by_code(codes, quantities)
+    new_df = pd.DataFrame({'code': unique_codes, 'quantity': sums})
+    if state.empty:
+        return new_df
+
+    return (
+        pd.concat([state, new_df], copy=False, ignore_index=True)
+        .groupby('code', as_index=False, sort=False)['quantity'].sum()
+    )
+
+def current_time_strings(timezone_str: str) -> Tuple[str, str, str]:
+    """Retorna as strings de data e hora (conteúdo e nome de arquivo) de uma vez.
+
+    Um único `datetime.now` atende o conteúdo formatado e o nome do arquivo,
+    evitando relógios lidos em momentos diferentes dentro do mesmo clique.
+    """
     try:
-        tz = pytz.timezone(timezone_str)
-        now = datetime.now(tz)
-        date_str = now.strftime("%Y%m%d")
-        time_str_content = now.strftime("%H%M%S")
-    except pytz.UnknownTimeZoneError:
-        now = datetime.utcnow()
-        date_str = now.strftime("%Y%m%d")
-        time_str_content = now.strftime("%H%M%S")
-
-    result_lines = []
-    for item in sorted_data:
-        if layout == "Layout InovaFarma":
-            line = f"{item['code']},{item['quantity']}"
-            result_lines.append(line)
-        else:
-            base_line = f"{date_str},{time_str_content},{item['code']},{item['quantity']}"
-            if layout != "Layout Apha7":
-                layout_suffix = layout.replace(" ", "")
-                base_line += f",{layout_suffix}"
-            result_lines.append(base_line)
-
-    return "\n".join(result_lines)
-
-def generate_filename(layout: str, timezone_str: str) -> str:
-    """Gera um nome de arquivo dinâmico para o download."""
-    try:
-        tz = pytz.timezone(timezone_str)
-        now = datetime.now(tz)
+        now = datetime.now(_get_tz(timezone_str))
     except pytz.UnknownTimeZoneError:
         now = datetime.utcnow()
 
     date_str = now.strftime("%Y%m%d")
-    time_str_filename = now.strftime("%H%M")
-    
-    layout_short = LAYOUT_OPTIONS.get(layout, "Layout").replace(" ", "")
-    
+    time_str_content = now.strftime("%H%M%S")
+    time_str_filename = time_str_content[:4]
+
+    return date_str, time_str_content, time_str_filename
+
+@st.cache_data(show_spinner=False)
+def format_output_data(data: pd.DataFrame, layout: str, date_str: str, time_str_content: str) -> str:
+    """Formata os dados processados no layout de saída especificado.
+
+    Memoizada: alternar widgets sem mudar dados, layout ou horário reaproveita
+    o resultado já ordenado e concatenado.
+    """
+    if data.empty:
+        return ""
+
+    # sort_values despacha para o Timsort em C do NumPy sobre o buffer
+    # int64, sem callback Python por comparação.
+    sorted_data = data.sort_values('quantity', kind='stable', ignore_index=True)
+
+    # A decisão de layout é resolvida uma única vez, antes de qualquer
+    # montagem: prefixo e sufixo viram constantes e as linhas são montadas
+    # com concatenações vetorizadas de Series, que escrevem cada campo
+    # literalmente — um writer CSV colocaria códigos com aspas entre aspas,
+    # alterando bytes que o formato original emitia como estão.
+    suffix = _LAYOUT_SUFFIX.get(layout)
+    if suffix is None:
+        suffix = layout.replace(" ", "")
+
+    lines = sorted_data['code'].astype(str) + ',' + sorted_data['quantity'].astype(str)
+    if layout != "Layout InovaFarma":
+        lines = f"{date_str},{time_str_content}," + lines
+    if suffix:
+        lines = lines + ("," + suffix)
+
+    return lines.str.cat(sep='\n')
+
+def generate_filename(layout: str, date_str: str, time_str_filename: str) -> str:
+    """Gera um nome de arquivo dinâmico para o download."""
+    layout_short = _LAYOUT_SHORT.get(layout, "Layout")
+
     return f"Dados_Consolidados_{layout_short}_{date_str}_{time_str_filename}.txt"
 
 # --- Interface do Usuário (Streamlit) ---
@@ -150,6 +334,13 @@ selected_layout = st.sidebar.selectbox(
     options=list(LAYOUT_OPTIONS.keys()),
     help="Selecione o formato final do arquivo de texto consolidado."
 )
+max_rows_per_file = st.sidebar.number_input(
+    "Limite de linhas por arquivo:",
+    min_value=0,
+    value=0,
+    step=1000,
+    help="0 = sem limite. Com um limite, a leitura de arquivos maiores é interrompida nesse ponto."
+)
 
 # --- Área Principal ---
 col1, col2 = st.columns([1, 2])
@@ -174,17 +365,26 @@ with col2:
     )
 
     if uploaded_files:
-        new_files_to_process = [f for f in uploaded_files if f.name not in st.session_state.processed_files]
+        new_files_to_process = []
+        for file in uploaded_files:
+            file_key = file_identity_key(file)
+            if file_key not in st.session_state.processed_files:
+                new_files_to_process.append((file, file_key))
         if new_files_to_process:
             with st.spinner("Lendo novos arquivos..."):
-                for file in new_files_to_process:
-                    data, errors = parse_uploaded_file(file)
-                    st.session_state.processed_data.extend(data)
-                    st.session_state.errors.extend(errors)
-                    st.session_state.processed_files.add(file.name)
+                for file, file_key in new_files_to_process:
+                    codes, quantities, errors = parse_uploaded_file(file, max_rows_per_file)
+                    st.session_state.processed_data = accumulate_data(
+                        st.session_state.processed_data, codes, quantities
+                    )
+                    st.session_state.total_rows += len(codes)
+                    st.session_state.errors.extend(
+                        (file.name, line, kind, value) for line, kind, value in errors
+                    )
+                    st.session_state.processed_files.add(file_key)
             st.rerun()
 
-    total_items = len(st.session_state.processed_data)
+    total_items = st.session_state.total_rows
     
     if total_items > 0:
         st.success(f"**{total_items}** linhas de **{len(st.session_state.processed_files)}** arquivo(s) carregadas e prontas para processar.")
@@ -192,19 +392,19 @@ with col2:
     if st.session_state.errors:
         st.error("❌ Foram encontrados erros em alguns arquivos:")
         with st.expander("Clique para ver os detalhes dos erros"):
-            for error in st.session_state.errors:
-                st.write(f"- {error}")
+            st.write(format_error_messages(st.session_state.errors))
         st.warning("As linhas com erro foram ignoradas.")
     
     btn_col1, btn_col2 = st.columns(2)
 
     with btn_col1:
-        if st.button("🚀 Processar Dados Acumulados", disabled=not st.session_state.processed_data, use_container_width=True):
+        if st.button("🚀 Processar Dados Acumulados", disabled=st.session_state.processed_data.empty, use_container_width=True):
             st.session_state.run_processing = True
     
     with btn_col2:
         if st.button("🧹 Limpar e Recomeçar", use_container_width=True):
-            st.session_state.processed_data = []
+            st.session_state.processed_data = _empty_state_df()
+            st.session_state.total_rows = 0
             st.session_state.errors = []
             st.session_state.processed_files = set()
             if 'run_processing' in st.session_state:
@@ -215,13 +415,14 @@ with col2:
         st.markdown("---")
         st.header("Resultado Consolidado")
 
-        # **NOVA ETAPA**: Agrega os dados antes de formatar
-        final_data = aggregate_data(st.session_state.processed_data)
+        # Os dados já chegam agregados do envio; resta só o formato final
+        final_data = st.session_state.processed_data
 
-        st.info(f"Dados consolidados: **{len(st.session_state.processed_data)}** linhas foram agrupadas em **{len(final_data)}** códigos únicos.")
+        st.info(f"Dados consolidados: **{st.session_state.total_rows}** linhas foram agrupadas em **{len(final_data)}** códigos únicos.")
 
-        result_text = format_output_data(final_data, selected_layout, TIMEZONE)
-        download_file_name = generate_filename(selected_layout, TIMEZONE)
+        date_str, time_str_content, time_str_filename = current_time_strings(TIMEZONE)
+        result_text = format_output_data(final_data, selected_layout, date_str, time_str_content)
+        download_file_name = generate_filename(selected_layout, date_str, time_str_filename)
 
         st.text_area(
             f"Resultado formatado ({selected_layout}):",
@@ -232,7 +433,7 @@ with col2:
 
         st.download_button(
             label="⬇️ Baixar Resultado Consolidado",
-            data=result_text,
+            data=result_text.encode("utf-8"),
             file_name=download_file_name,
             mime="text/plain",
             use_container_width=True